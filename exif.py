@@ -4,8 +4,10 @@ Author: Zach Greenhalge
 A program that parses EXIF markers from a JPEG
 """
 
-import sys, codecs
-from struct import unpack
+import sys, codecs, mmap, struct, functools, getopt, os, time, json, csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from struct import unpack, unpack_from
 
 TAGS={      0x100:  "ImageWidth",
 	        0x101:  "ImageLength",
@@ -109,130 +111,413 @@ TAGS={      0x100:  "ImageWidth",
 	        0xA435: "LensSerialNumber"
 }
 
+GPSTAGS={   0x0:    "GPSVersionID",
+	        0x1:    "GPSLatitudeRef",
+	        0x2:    "GPSLatitude",
+	        0x3:    "GPSLongitudeRef",
+	        0x4:    "GPSLongitude",
+	        0x5:    "GPSAltitudeRef",
+	        0x6:    "GPSAltitude",
+	        0x7:    "GPSTimeStamp",
+	        0x8:    "GPSSatellites",
+	        0x9:    "GPSStatus",
+	        0xA:    "GPSMeasureMode",
+	        0xB:    "GPSDOP",
+	        0xC:    "GPSSpeedRef",
+	        0xD:    "GPSSpeed",
+	        0xE:    "GPSTrackRef",
+	        0xF:    "GPSTrack",
+	        0x10:   "GPSImgDirectionRef",
+	        0x11:   "GPSImgDirection",
+	        0x12:   "GPSMapDatum",
+	        0x13:   "GPSDestLatitudeRef",
+	        0x14:   "GPSDestLatitude",
+	        0x15:   "GPSDestLongitudeRef",
+	        0x16:   "GPSDestLongitude",
+	        0x17:   "GPSDestBearingRef",
+	        0x18:   "GPSDestBearing",
+	        0x19:   "GPSDestDistanceRef",
+	        0x1A:   "GPSDestDistance",
+	        0x1B:   "GPSProcessingMethod",
+	        0x1C:   "GPSAreaInformation",
+	        0x1D:   "GPSDateStamp",
+	        0x1E:   "GPSDifferential",
+	        0x1F:   "GPSHPositioningError"
+}
+
+INTEROPTAGS={0x1:   "InteroperabilityIndex",
+	        0x2:    "InteroperabilityVersion",
+	        0x1000: "RelatedImageFileFormat",
+	        0x1001: "RelatedImageWidth",
+	        0x1002: "RelatedImageLength"
+}
+
+SUBIFDS = {0x8769: ("Exif IFD", TAGS), 0x8825: ("GPS IFD", GPSTAGS), 0xA005: ("Interoperability IFD", INTEROPTAGS)} #pointer tag -> kind and tag names of the IFD it points to
+
+CODES = {name: tag for table in (TAGS, GPSTAGS, INTEROPTAGS) for tag, name in table.items()}
+COLUMNS = ["Make", "Model", "DateTime", "DateTimeOriginal", "Orientation", "PixelXDimension", "PixelYDimension"] #default CSV tags
+BATCH = 64 #files per worker task
+
 typeLength=[0,1,1,2,4,8,1,1,2,4,8,4,8]
+typeCodes=[None,"B","s","H","L","L","b","s","h","l","l","f","d"] #struct codes, rationals being two of theirs per component
+BYTEORDERS = {b'II': "<", b'MM': ">"}
+RECORDS = {order: struct.Struct(order + "HHL4s") for order in "<>"} #one 12 byte IFD directory record
+STANDALONE = {0xFF01, 0xFFD8, 0xFFD9} | set(range(0xFFD0, 0xFFD8)) #markers with no length field after them
+
+class ExifError(Exception):
+	"""Raised for a file that is not a JPEG, or whose markers or EXIF data are malformed"""
 
 class IFDEntry:
-	"""A container class for all data relevant to an IFD entry"""
+	"""A container class for all data relevant to an IFD entry
+	Built from its 12 byte directory record; the value is only decoded, and out of line values only read, when data is first used"""
+	__slots__ = ("buf", "order", "names", "location", "offsetStart", "tag", "format", "components", "field", "_data")
 	printStr = "{:>5s} {:20s} {}"
-	def __init__(self, fd, offsetStart):
-		self.location   = fd.tell()
-		self.tag        = unpack(">H", fd.read(2))[0]
-		self.name       = TAGS[int("{:d}".format(self.tag))]
-		self.format     = unpack(">H", fd.read(2))[0]
-		self.components = unpack(">L", fd.read(4))[0]
-		self.dataLength = typeLength[self.format] * self.components
-		if self.dataLength > 4:
-			self.offset = unpack(">L", fd.read(4))[0]
-			fd.seek(offsetStart+self.offset)
-			self.data   = fd.read(self.dataLength)
-		else:
-			self.offset = 0
-			self.data   = fd.read(self.dataLength)
-		self.data       = dataFromBytes(self.format, self.components, bytes(self.data))
+	def __init__(self, buf, order, names, location, offsetStart, tag, fmt, components, field):
+		self.buf        = buf
+		self.names      = names #tag names of the IFD the entry is in
+		self.order      = order
+		self.location   = location
+		self.offsetStart = offsetStart
+		self.tag        = tag
+		self.format     = fmt
+		self.components = components
+		self.field      = field #the value itself when it fits in 4 bytes, else its offset
+		self._data      = None
+
+	@property
+	def name(self):
+		return self.names.get(self.tag) or "0x{:04X}".format(self.tag)
 
-		fd.seek(self.location+12)
-		print(self.printStr.format("{:x}".format(self.tag), self.name, self.data))
+	@property
+	def dataLength(self):
+		return typeLength[self.format] * self.components if self.format < len(typeLength) else 0
+
+	@property
+	def offset(self):
+		return unpack(self.order + "L", self.field)[0] if self.dataLength > 4 else 0
+
+	@property
+	def raw(self):
+		"""The value's bytes as a memoryview over the buffer rather than a copy, which keeps the buffer open until released"""
+		length = self.dataLength
+		if length <= 4:
+			return memoryview(self.field)[:length]
+		return view(self.buf, self.offsetStart + self.offset, length)
+
+	@property
+	def data(self):
+		if self._data is None:
+			if self.dataLength > 4:
+				buf, start = self.buf, self.offsetStart + self.offset
+			else:
+				buf, start = self.field, 0
+			try:
+				self._data = dataFromBytes(self.format, self.components, buf, start, self.order)
+			except struct.error:
+				raise ExifError("Value of tag 0x{:X} at 0x{:X} runs past the end of the data".format(self.tag, self.location))
+		return self._data
 
 class IFD:
-	"""Basically just a list of IFDEntry"""
-	def __init__(self, fd, offset):
-		self.entrynum = unpack(">H", fd.read(2))[0]
-		self.entries = []
-		print("Number of IFD Entries:", self.entrynum)
-		while len(self.entries) < self.entrynum:
-			self.entries.append(IFDEntry(fd, offset))
+	"""Basically just a list of IFDEntry, read from the directory in one slice and only turned into entries when asked
+	kind says which IFD it is, and next is the offset of the IFD chained after it, or 0"""
+	__slots__ = ("buf", "order", "kind", "names", "location", "offsetStart", "entrynum", "table", "next", "_entries")
+	def __init__(self, buf, location, offsetStart, order=">", kind="IFD", names=TAGS):
+		self.buf = buf
+		self.order = order
+		self.kind = kind
+		self.names = names
+		self.location = location
+		self.offsetStart = offsetStart
+		self.entrynum = unpack_from(order + "H", buf, location)[0]
+		self.table = bytes(buf[location+2:location+2+12*self.entrynum])
+		if len(self.table) != 12*self.entrynum:
+			raise ExifError("Truncated IFD at 0x{:X}".format(location))
+		link = buf[location+2+12*self.entrynum:location+6+12*self.entrynum]
+		self.next = unpack(order + "L", link)[0] if len(link) == 4 else 0
+		self._entries = None
 
+	@property
+	def entries(self):
+		if self._entries is None:
+			self._entries = [IFDEntry(self.buf, self.order, self.names, self.location + 2 + 12*i, self.offsetStart, *record) for i, record in enumerate(RECORDS[self.order].iter_unpack(self.table))]
+		return self._entries
 
+	def get(self, tag):
+		"""Returns the entry for tag, or None, without building entries for the rest of the directory"""
+		if self._entries is not None:
+			return next((entry for entry in self._entries if entry.tag == tag), None)
+		for i, record in enumerate(RECORDS[self.order].iter_unpack(self.table)):
+			if record[0] == tag:
+				return IFDEntry(self.buf, self.order, self.names, self.location + 2 + 12*i, self.offsetStart, *record)
+		return None
 
 class App:
-	"""A container class for all data relevant to an App"""
+	"""A container class for all data relevant to an App, located by its offset in the file"""
 	printStr = "[0x{:04X}] Marker 0x{:04X} size=0x{:04X}"
-	def __init__(self, marker, fd):
-		"""Extract the data for the app from the marker and file descriptor"""
-		if marker == b'\xFF\xDA': #image data header
-			self.marker = unpack(">H", marker)[0]
-			self.size = unpack(">H", fd.read(2))[0]
-			self.location = fd.tell() - 2
-			self.next = self.size + self.location + 2
-			print(self.printStr.format(self.location, self.marker, self.size))
-			sys.exit(0)
-		if marker[0] != 0xFF: #All headers are two bytes, starting with 0xFF
-			print("Invalid marker found.", marker, "Exiting.")
-			sys.exit(1)
-		self.marker   = unpack(">H", marker)[0]
-		self.size     = unpack(">H", fd.read(2))[0]
-		self.location = fd.tell() - 4
+	def __init__(self, buf, location):
+		"""Extract the data for the app at location in buf"""
+		self.location = location
+		self.marker   = unpack_from(">H", buf, location)[0]
+		self.size     = 0 if self.marker in STANDALONE else unpack_from(">H", buf, location+2)[0]
 		self.next     = self.size + self.location + 2
-		self.name     = unpack(">6s", fd.read(6))[0].strip(b'\x00')
-		print(self.printStr.format(self.location, self.marker, self.size))
-		if checkforExif():
-			self.IFD = IFD(fd, self.location+10)
-		fd.seek(self.next)
-
-	def checkforExif():
-		"""Returns true if this app is the Exif data. Can exit the program if an error is detected"""
-		if self.name == b'Exif':
-			temp = fd.read(2)
-			if temp != b'MM':
-				print("Little endian format found. Exiting.")
-				sys.exit(1)
-			temp = fd.read(2)
-			if temp != b'\x00\x2A':
-				print("Incorrect format of marker", self.name, "Exiting.")
-				sys.exit(1)
-			self.offset = unpack(">L", fd.read(4))[0]
-			if self.offset != fd.tell() - self.location - 10: #location - start - 10 bytes to first M
-				print("Incorect IFD offset in marker", self.name)
-				print("Was", fd.tell() - self.location - 10, "expected", self.offset)
-				sys.exit(1)
-			return True
-		return False
-
-def dataFromBytes(fmt, components, bytestr):
-	"""Takes a bytestr and returns it in the specified format"""
-	ret = bytestr
-	if   fmt == 1: #byte
-		ret = unpack(">{:}B".format(len(bytestr)), bytestr)[0]
-	elif fmt == 2: #ASCII string
-		ret = bytes.decode(bytestr)
-	elif fmt == 3: #short
-		ret = unpack(">{:}H".format(components), bytestr)[0]
-	elif fmt == 4: #long
-		ret = unpack(">{:}L".format(components), bytestr)[0]
-	elif fmt == 5: #rational
-		ret = unpackRational(components, bytestr)
-	elif fmt == 7: #raw data
-		ret = "".join(*unpack(">{:}B".format(components), bytestr))
-	return ret
-
-def unpackRational(components, bytestr):
-	"""Unpacks a given number of rationals from the bytestr"""
-	ret = []
-	size = len(ret)
-	while size <= components:
-		string = bytestr[size:size+8]
-		if len(string) >= 8:
-			ret.append("{}/{}".format(*unpack(">LL", string)))
-		size += 8
-	return ret
+		self.name     = b''
+		self.IFD      = None
+		self.IFDs     = []
+		if 0xFFE0 <= self.marker <= 0xFFEF: #APPn segments start with a zero terminated identifier
+			self.name = bytes(buf[location+4:location+10]).strip(b'\x00')
+		if self.checkforExif(buf):
+			self.IFDs = self.readIFDs(buf)
+			self.IFD = self.IFDs[0]
+
+	def readIFDs(self, buf):
+		"""Returns IFD0 and every IFD reachable from it through the sub IFD pointer tags and next IFD links, breadth first
+		Each offset is only read once, so links that loop back or share an IFD can't make this loop or repeat work"""
+		start = self.location + 10
+		ifds = []
+		visited = set()
+		todo = deque([(self.offset, "IFD", TAGS)])
+		chained = 0
+		while todo:
+			offset, kind, names = todo.popleft()
+			if offset in visited or offset < 8 or start + offset + 2 > len(buf):
+				continue
+			visited.add(offset)
+			ifd = IFD(buf, start + offset, start, self.order, kind, names)
+			ifds.append(ifd)
+			if names is TAGS:
+				for tag, (sub, subnames) in SUBIFDS.items():
+					entry = ifd.get(tag)
+					if entry is not None and isinstance(entry.data, int):
+						todo.append((entry.data, sub, subnames))
+			if ifd.next and kind.startswith("IFD"): #only the main chain, IFD0 then the thumbnail IFD1, links onwards
+				chained += 1
+				todo.append((ifd.next, "IFD{}".format(chained), TAGS))
+		return ifds
+
+	def thumbnail(self):
+		"""The embedded JPEG thumbnail as a memoryview over the scanned buffer, or None when there is none"""
+		for ifd in self.IFDs:
+			if ifd.names is TAGS:
+				start, length = ifd.get(0x201), ifd.get(0x202) #JPEGInterchangeFormat and JPEGInterchangeFormatLength
+				if start is not None and length is not None and isinstance(start.data, int) and isinstance(length.data, int):
+					return view(ifd.buf, ifd.offsetStart + start.data, length.data)
+		return None
+
+	def makerNote(self):
+		"""The MakerNote as a memoryview over the scanned buffer, or None when there is none"""
+		for ifd in self.IFDs:
+			entry = ifd.get(0x927C) if ifd.names is TAGS else None
+			if entry is not None:
+				return entry.raw
+		return None
+
+	def checkforExif(self, buf):
+		"""Returns true if this app is the Exif data. Raises ExifError if its TIFF header is malformed"""
+		if self.name != b'Exif':
+			return False
+		start = self.location + 10 #TIFF header, which IFD offsets count from
+		self.order = BYTEORDERS.get(bytes(buf[start:start+2]))
+		if self.order is None:
+			raise ExifError("Unknown byte order in marker {}".format(self.name))
+		if unpack_from(self.order + "H", buf, start+2)[0] != 0x2A:
+			raise ExifError("Incorrect format of marker {}".format(self.name))
+		self.offset = unpack_from(self.order + "L", buf, start+4)[0]
+		if not 8 <= self.offset < self.size - 8:
+			raise ExifError("Incorrect IFD offset {} in marker {}".format(self.offset, self.name))
+		return True
+
+def view(buf, start, length):
+	"""A memoryview of length bytes at start in buf, raising ExifError if they run past its end"""
+	if start + length > len(buf):
+		raise ExifError("Data at 0x{:X} runs past the end of the file".format(start))
+	return memoryview(buf)[start:start+length]
+
+def scan(buf):
+	"""Returns the segments of the JPEG in buf, a bytes like object or mmap of the file, as a list of App
+	Scanning stops at the start of scan segment, so only the header region is read"""
+	if buf[:2] != b'\xFF\xD8':
+		raise ExifError("File passed is not a JPEG")
+	apps = []
+	pos = 2
+	try:
+		while pos < len(buf):
+			if buf[pos] != 0xFF: #All headers are two bytes, starting with 0xFF
+				raise ExifError("Invalid marker 0x{:02X} found at 0x{:X}".format(buf[pos], pos))
+			if buf[pos+1] == 0xFF: #fill byte before a marker
+				pos += 1
+				continue
+			app = App(buf, pos)
+			apps.append(app)
+			if app.marker in (0xFFDA, 0xFFD9): #image data or end of image follows
+				break
+			pos = app.next
+	except (struct.error, IndexError):
+		raise ExifError("Truncated segment at 0x{:X}".format(pos))
+	return apps
+
+def report(apps, out=sys.stdout):
+	"""Prints the segments found by scan, with the entries of any Exif IFD"""
+	for app in apps:
+		print(app.printStr.format(app.location, app.marker, app.size), file=out)
+		for ifd in app.IFDs:
+			print("Number of {} Entries:".format(ifd.kind), ifd.entrynum, file=out)
+			for entry in ifd.entries:
+				print(entry.printStr.format("{:x}".format(entry.tag), entry.name, entry.data), file=out)
+
+@functools.lru_cache(maxsize=1024)
+def structFor(order, fmt, components):
+	"""The compiled struct for components values of type fmt in the given byte order"""
+	count = components * 2 if fmt in (5, 10) else components
+	return struct.Struct("{}{}{}".format(order, count, typeCodes[fmt]))
+
+def dataFromBytes(fmt, components, buf, offset=0, order=">"):
+	"""Decodes components values of type fmt from buf at offset with a single unpack_from
+	Single numbers come back as themselves, several as a list, rationals as "n/d" strings, strings up to their NUL and raw data as bytes"""
+	if not 0 < fmt < len(typeCodes):
+		return None
+	values = structFor(order, fmt, components).unpack_from(buf, offset)
+	if fmt == 2: #ASCII string
+		return values[0].split(b'\x00', 1)[0].decode("utf-8", "replace")
+	if fmt == 7: #raw data
+		return values[0]
+	if fmt in (5, 10): #rational
+		return ["{}/{}".format(n, d) for n, d in zip(values[0::2], values[1::2])]
+	return values[0] if components == 1 else list(values)
+
+def record(path, tags=None, thumbs=None):
+	"""Returns the EXIF of one file as a dict of tag name to value, parsed from an mmap so only the header pages are read
+	With tags, only those are decoded. With thumbs, the embedded thumbnail is written into that directory and its path
+	recorded. A file that can't be read or parsed gives its error instead"""
+	rec = {"path": path}
+	try:
+		with open(path, "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			for app in scan(mm):
+				fields(app, rec, tags)
+				if thumbs is not None and "thumbnail" not in rec:
+					thumb = app.thumbnail()
+					if thumb is not None:
+						with thumb:
+							rec["thumbnail"] = saveThumbnail(path, thumb, thumbs)
+	except Exception as e: #one bad file is reported in its record rather than ending the run
+		rec = {"path": path, "error": "{}: {}".format(type(e).__name__, e)}
+	return rec
+
+def saveThumbnail(path, thumb, thumbs):
+	"""Writes a thumbnail into the thumbs directory, named after the whole path of its image so names from different directories can't clash"""
+	name = os.path.join(thumbs, os.path.abspath(path).strip(os.sep).replace(os.sep, "_") + ".thumb.jpg")
+	with open(name, "wb") as out:
+		out.write(thumb)
+	return name
+
+def fields(app, rec, tags=None):
+	"""Adds the decoded tags of every IFD of app to rec, only those in tags if given"""
+	for ifd in app.IFDs:
+		prefix = "" if ifd.kind.endswith(" IFD") or ifd.kind == "IFD" else ifd.kind + "." #IFD1 repeats IFD0's tags for the thumbnail
+		if tags is None:
+			entries = ifd.entries
+		else:
+			entries = [entry for entry in map(ifd.get, (CODES[tag] for tag in tags if tag in CODES)) if entry is not None and entry.name in tags]
+		for entry in entries:
+			data = entry.data
+			rec.setdefault(prefix + entry.name, data.hex() if isinstance(data, bytes) else data)
+
+def records(paths, tags=None, thumbs=None):
+	"""Worker side of batch, the records of a list of files"""
+	return [record(path, tags, thumbs) for path in paths]
+
+def walk(paths, skip=None):
+	"""Yields every file under paths, which can be files or directory trees, leaving out the directory skip"""
+	skip = None if skip is None else os.path.realpath(skip)
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, names in os.walk(path):
+				if os.path.realpath(root) == skip:
+					dirs[:] = []
+					continue
+				dirs.sort()
+				for name in sorted(names):
+					yield os.path.join(root, name)
+		else:
+			yield path
+
+def batch(paths, jobs=1, out=sys.stdout, form="jsonl", tags=None, thumbs=None):
+	"""Streams one JSONL or CSV record per file under paths, parsing BATCH files per task across a process pool
+	With thumbs, embedded thumbnails are written into that directory as well, which the walk leaves out.
+	Records come out in walk order. Returns the number of files and of errors"""
+	if form == "csv":
+		writer = csv.DictWriter(out, ["path", "error"] + (tags or COLUMNS) + (["thumbnail"] if thumbs else []), extrasaction="ignore")
+		writer.writeheader()
+		write = writer.writerow
+		tags = tags or COLUMNS
+	else:
+		write = lambda rec: out.write(json.dumps(rec) + "\n")
+	files = errors = 0
+	def emit(recs):
+		nonlocal files, errors
+		for rec in recs:
+			files += 1
+			errors += "error" in rec
+			write(rec)
+	group = []
+	if jobs <= 1:
+		for path in walk(paths, thumbs):
+			emit([record(path, tags, thumbs)])
+		return files, errors
+	with ProcessPoolExecutor(jobs) as pool:
+		pending = deque()
+		for path in walk(paths, thumbs):
+			group.append(path)
+			if len(group) == BATCH:
+				pending.append(pool.submit(records, group, tags, thumbs))
+				group = []
+			while len(pending) > 2 * jobs:
+				emit(pending.popleft().result())
+		if group:
+			pending.append(pool.submit(records, group, tags, thumbs))
+		while pending:
+			emit(pending.popleft().result())
+	return files, errors
 
 def main(args):
-	"""Checks if the file passed is a JPEG, and reads in all JPEG apps if it is"""
+	"""Checks if the file passed is a JPEG, and reports all JPEG apps if it is
+	With -b, writes a record per file for every file under the paths given instead"""
+	try:
+		opts, args = getopt.getopt(args, "bj:f:t:x:")
+		opts = dict(opts)
+		jobs = int(opts.get("-j", os.cpu_count() or 1))
+	except (getopt.GetoptError, ValueError):
+		usage()
+		sys.exit(2)
+	if "-b" in opts:
+		form = opts.get("-f", "jsonl")
+		tags = opts["-t"].split(",") if "-t" in opts else None
+		thumbs = opts.get("-x")
+		if not args or form not in ("jsonl", "csv"):
+			usage()
+			sys.exit(2)
+		if thumbs is not None:
+			os.makedirs(thumbs, exist_ok=True)
+		start = time.perf_counter()
+		files, errors = batch(args, jobs, sys.stdout, form, tags, thumbs)
+		elapsed = time.perf_counter() - start
+		print("{} files, {} errors, {:.3f}s, {:.1f} files/s".format(files, errors, elapsed, files / elapsed if elapsed else 0), file=sys.stderr)
+		return
 	if len(args) != 1:
 		usage()
 		sys.exit(2)
-	apps = []
-	with open(args[0], "rb") as fd:
-		if unpack(">H", fd.read(2))[0] != 0xFFD8:
-			print("File passed is not a JPEG")
-			sys.exit(1)
-		marker = fd.read(2)
-		while marker != b'\xFF\xD9': #0xFFD9 == EOF in JPEG
-			apps.append(App(marker, fd))
-			marker = fd.read(2)
+	try:
+		with open(args[0], "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			report(scan(mm)) #entries decode lazily, so report while the file is still mapped
+	except (ExifError, ValueError) as e: #mmap raises ValueError for an empty file
+		print(e)
+		sys.exit(1)
+	except IOError as e:
+		print("Exception raised: " + str(e))
+		sys.exit(1)
 
 def usage():
 	print("exif <file>")
+	print("exif -b [-j <jobs>] [-f jsonl|csv] [-t <tag>,<tag>...] [-x <thumbnail dir>] <file or dir>...")
 
 if __name__ == '__main__':
-	main(sys.argv[1:])
\ No newline at end of file
+	main(sys.argv[1:])
@@ -4,7 +4,18 @@ Author: Zach Greenhalge
 A script to perform character frequency analysis on a body of text
 """
 
-import sys, getopt, collections
+import sys, getopt, collections, re, os, json, functools
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+try:
+	import numpy
+except ImportError:
+	numpy = None #scoring falls back to plain python
+
+CHUNK = 1 << 20 #characters read at a time
+DENSE = 4 #n-grams up to this length are counted in an array of 26^n slots
+NONLETTERS = re.compile("[^a-z]+")
+WORDS = re.compile(r"[^\W_]+(?:'[^\W_]+)*") #runs of letters and digits, keeping contractions like don't
 	
 digrams = False
 trigrams = False
@@ -43,61 +54,315 @@ def main(argv):
 	global digrams, trigrams, sort, inverse, whitespace
 	target = ""
 	inFile = None
+	words = False
+	grams = []
+	top = None
+	score = False
+	caesar = False
+	corpusDir = None
+	sketch = None
+	jobs = os.cpu_count() or 1
+	partials = None
+	counts = None
 	
 
 	try:
-		opts, args = getopt.getopt(argv, "i:s:dtfw")
+		opts, args = getopt.getopt(argv, "i:s:dtfwn:k:xcr:j:p:m:")
 	except getopt.GetoptError:
 		print("GetoptError")
 		usage()
 	if len(opts) == 0:
 		print("Len error")
 		usage()
-	for tup in opts:
-		#Initialize  option values
-		if tup[0] == "-i":
+	try:
+		for tup in opts:
+			#Initialize  option values
+			if tup[0] == "-i":
+				inFile = tup[1]
+			elif tup[0] == "-s":
+				target = tup[1]
+				print("Analyzing string...")
+			elif tup[0] == "-d":
+				digrams = True
+			elif tup[0] == "-t":
+				trigrams = True
+			elif tup[0] == "-f":
+				sort = lambda item: item[1]
+				inverse = True
+			elif tup[0] == "-w":
+				words = True
+			elif tup[0] == "-n":
+				grams.append(int(tup[1]))
+			elif tup[0] == "-k":
+				top = int(tup[1])
+			elif tup[0] == "-x":
+				score = True
+			elif tup[0] == "-c":
+				caesar = True
+			elif tup[0] == "-r":
+				corpusDir = tup[1]
+			elif tup[0] == "-j":
+				jobs = int(tup[1])
+			elif tup[0] == "-p":
+				partials = tup[1]
+			elif tup[0] == "-m":
+				sketch = int(tup[1])
+	except ValueError:
+		print("ValueError")
+		usage()
+	if any(n < 1 for n in grams) or (sketch is not None and sketch < 1) or (top is not None and top < 1):
+		usage()
+	if inFile is None:
+		chunks = [target]
+	else:
+		try:
+			inFile = open(inFile, "r", errors="replace")
+			print("Analyzing " + inFile.name + "...")
+		except Exception as e:
+			print(e)
+			sys.exit(1)
+		chunks = iter(lambda: inFile.read(CHUNK), "")
+	if corpusDir is not None:
+		if words or digrams or trigrams or grams:
+			print("-r only counts characters")
+			usage()
+		print("Analyzing " + corpusDir + "...")
+		counts = corpus(corpusDir, jobs, partials)
+	if words and sketch:
+		table = CountMin(sketch, top=top or 20)
+		for found in wordChunks(chunks):
+			table.update(found)
+		print("Approximate counts from a {}x{} count-min sketch".format(len(table.rows), sketch))
+		report(table.counts(), top or 20, "words", table.total)
+	elif words:
+		counts = collections.Counter()
+		for found in wordChunks(chunks):
+			counts.update(found)
+		report(counts, top, "words")
+	elif score or caesar:
+		hist = histogram(count(chunks) if counts is None else counts)
+		if score:
+			print("Chi-squared against english: {:10.04f}".format(scoreKeys(hist, [range(26)])[0]))
+			print("Index of coincidence:        {:10.04f}".format(coincidence(hist)))
+		if caesar:
+			ranked = sorted(enumerate(scoreKeys(hist, shifts())), key=lambda item: item[1])
+			print("{:>5s}  {:>12s}".format("shift", "chi-squared"))
+			print("-"*40)
+			for shift, chi in ranked[:top]:
+				print("{:5d}  {:12.04f}".format(shift, chi))
+	elif digrams or trigrams or grams:
+		sizes = sorted(set(grams + [n for n, flag in ((2, digrams), (3, trigrams)) if flag]))
+		tables = [NGrams(n) for n in sizes]
+		for chunk in chunks:
+			letters = NONLETTERS.sub("", chunk.lower())
+			for table in tables:
+				table.update(letters)
+		for table in tables:
+			report(table.counts(), top, table.label())
+	else:
+		report(count(chunks) if counts is None else counts, top)
+	if inFile is not None:
+		inFile.close()
+
+def count(chunks):
+	"""Counts every character in a stream of chunks, lowercased, as integers"""
+	counts = collections.Counter()
+	for chunk in chunks:
+		counts.update(chunk.lower())
+	return counts
+
+def corpus(root, jobs, partials=None):
+	"""Counts the characters of every file under root across a process pool, and merges the per file counts
+	With partials, the counts of each file are saved to that JSON file along with its size and mtime, and on the next
+	run only files that are new or have changed are counted again"""
+	saved = {}
+	if partials is not None and os.path.exists(partials):
+		with open(partials) as fd:
+			saved = json.load(fd)
+	files = {}
+	skip = None if partials is None else os.path.abspath(partials) #may live under root, and is not text to count
+	for path, dirs, names in os.walk(root):
+		for name in names:
+			name = os.path.join(path, name)
+			if os.path.abspath(name) == skip:
+				continue
 			try:
-				inFile = open(tup[1], "r")
-				target = inFile.read()
-				print("Analyzing " + tup[1] + "...")
-			except Exception as e:
-				print(e)
-				sys.exit(1)
-		elif tup[0] == "-s":
-			target = tup[1]
-			print("Analyzing string...")
-		elif tup[0] == "-d":
-			digrams = True
-		elif tup[0] == "-t":
-			trigrams = True
-		elif tup[0] == "-f":
-			sort = lambda item: item[1]
-			inverse = True
-		elif tup[0] == "-w":
-			print(len(target))
-			target = target.split()
-			print(len(target))
-	process(target)
-
-def process(target):
-	freq = {}
-	length = len(target)
-	for c in target:
-		#Count frequencies in target
-		char = c.lower()
-		if char in freq:
-			freq[char] = freq[char] + 1/length
-		else:
-			freq[char] = 1/length
-	freq = sorted(freq.items(), key=sort, reverse=inverse)
-	print("{:04d} distinct characters found out of {:} total characters".format(len(freq), length))
+				stat = os.stat(name)
+			except OSError:
+				print("Could not read " + name)
+				continue
+			files[name] = [stat.st_size, stat.st_mtime_ns]
+	todo = [name for name, stamp in files.items() if name not in saved or saved[name]["stamp"] != stamp]
+	entries = {name: saved[name] for name in files if name not in todo}
+	print("{} files, {} to count".format(len(files), len(todo)))
+	if todo:
+		with ProcessPoolExecutor(max(1, jobs)) as pool:
+			for name, counts in zip(todo, pool.map(countFile, todo, chunksize=16)):
+				if counts is None:
+					print("Could not read " + name)
+					continue
+				entries[name] = {"stamp": files[name], "counts": counts}
+	if partials is not None:
+		with open(partials, "w") as fd:
+			json.dump(entries, fd)
+	return functools.reduce(merge, (entry["counts"] for entry in entries.values()), collections.Counter())
+
+def countFile(path):
+	"""Worker side of corpus, returns the character counts of one file as a dict, or None if it can't be read"""
+	try:
+		with open(path, "r", errors="replace") as fd:
+			return dict(count(iter(lambda: fd.read(CHUNK), "")))
+	except OSError:
+		return None
+
+def merge(total, counts):
+	"""Adds counts into total and returns it, the reduce step for per file counts"""
+	total.update(counts)
+	return total
+
+def report(counts, top=None, label="characters", length=None):
+	"""Prints the frequency of each counted item, normalized once over the total
+	With top, only the top most frequent items are printed, most frequent first.
+	length is the total when counts only holds some of the items"""
+	if length is None:
+		length = sum(counts.values())
+		print("{:04d} distinct {} found out of {:} total {}".format(len(counts), label, length, label))
+	else:
+		print("Top {} {} out of {:} total {}".format(len(counts), label, length, label))
+	if top is None:
+		freq = sorted(((item, n / length) for item, n in counts.items()), key=sort, reverse=inverse)
+	else:
+		freq = [(item, n / length) for item, n in counts.most_common(top)]
 	print("-"*40)
 	for tup in freq:
 		#print out frequencies of target
 		print("'{}': {:8.04f}".format(tup[0], tup[1]))
 
+def wordChunks(chunks):
+	"""Yields the lowercased words of each chunk in a stream
+	A word cut off by the end of a chunk is carried into the next one rather than counted in two pieces"""
+	carry = ""
+	for chunk in chunks:
+		text = carry + chunk.lower()
+		cut = len(text)
+		while cut and (text[cut - 1].isalnum() or text[cut - 1] == "'"):
+			cut -= 1
+		carry = text[cut:]
+		yield WORDS.findall(text, 0, cut)
+	yield WORDS.findall(carry)
+
+def histogram(counts):
+	"""Returns the counts of the letters a-z as a list of 26 integers"""
+	return [counts.get(chr(97 + i), 0) for i in range(26)]
+
+def coincidence(hist):
+	"""Index of coincidence of a letter histogram, about 0.067 for english and 0.038 for uniform text"""
+	total = sum(hist)
+	if total < 2:
+		return 0.0
+	return sum(n * (n - 1) for n in hist) / (total * (total - 1))
+
+def shifts():
+	"""Keys for the 26 Caesar shifts, key[s][p] is the ciphertext letter that plaintext letter p becomes under shift s"""
+	return [[(p + s) % 26 for p in range(26)] for s in range(26)]
+
+def scoreKeys(hist, keys):
+	"""Chi-squared of the text against english after decrypting with each key, lower is closer to english
+	key[p] is the ciphertext letter standing for plaintext letter p, so every candidate is scored from the one histogram,
+	with a single gather over all the keys when numpy is available"""
+	total = sum(hist)
+	expected = [total * english[chr(97 + p)] for p in range(26)]
+	if total == 0:
+		return [0.0] * len(keys)
+	if numpy is not None:
+		observed = numpy.asarray(hist, dtype=numpy.float64)[numpy.asarray(keys, dtype=numpy.intp)]
+		expected = numpy.asarray(expected)
+		return ((observed - expected) ** 2 / expected).sum(axis=1).tolist()
+	return [sum((hist[c] - e) ** 2 / e for c, e in zip(key, expected)) for key in keys]
+
+class CountMin:
+	"""Approximate word counts in fixed memory, for vocabularies too big for a Counter
+	Each word is hashed into one slot per row and its count is the smallest of those slots, which can only overestimate.
+	The top heaviest words are kept alongside with their estimates"""
+	def __init__(self, width, depth=4, top=20):
+		self.width = width
+		self.rows = [array("Q", bytes(8 * width)) for i in range(depth)]
+		self.top = top
+		self.heavy = {} #word -> estimate, for at most top words
+		self.floor = 0 #smallest estimate in heavy once it is full
+		self.total = 0
+
+	def update(self, words):
+		"""Adds a chunk's words, counted together first so each distinct word is only hashed once per chunk"""
+		self.total += len(words)
+		for word, num in collections.Counter(words).items():
+			est = None
+			for seed, row in enumerate(self.rows):
+				slot = hash((seed, word)) % self.width
+				row[slot] += num
+				if est is None or row[slot] < est:
+					est = row[slot]
+			if word in self.heavy:
+				self.heavy[word] = est
+			elif len(self.heavy) < self.top:
+				self.heavy[word] = est
+				self.floor = min(self.heavy.values())
+			elif est > self.floor:
+				del self.heavy[min(self.heavy, key=self.heavy.get)]
+				self.heavy[word] = est
+				self.floor = min(self.heavy.values())
+
+	def counts(self):
+		"""Returns a Counter of the heaviest words and their estimated counts"""
+		return collections.Counter(self.heavy)
+
+class NGrams:
+	"""Counts the n letter sequences in a stream of text, where only the letters a-z are kept
+	The last n-1 letters of each update are carried over, so sequences across chunk boundaries are counted"""
+	def __init__(self, n):
+		self.n = n
+		self.carry = ""
+		if n <= DENSE:
+			self.table = array("Q", bytes(8 * 26 ** n)) #slot = the sequence read as a base 26 number
+		else:
+			self.table = collections.Counter()
+
+	def update(self, letters):
+		"""Adds the sequences in the next chunk of letters"""
+		text = self.carry + letters
+		self.carry = text[max(0, len(text) - self.n + 1):] if self.n > 1 else ""
+		if len(text) < self.n:
+			return
+		seqs = collections.Counter(zip(*[text[i:] for i in range(self.n)]))
+		if self.n > DENSE:
+			for seq, num in seqs.items():
+				self.table["".join(seq)] += num
+			return
+		for seq, num in seqs.items():
+			slot = 0
+			for letter in seq:
+				slot = slot * 26 + ord(letter) - 97
+			self.table[slot] += num
+
+	def counts(self):
+		"""Returns a Counter of the sequences seen"""
+		if self.n > DENSE:
+			return self.table
+		ret = collections.Counter()
+		for slot, num in enumerate(self.table):
+			if num:
+				seq = ""
+				for i in range(self.n):
+					slot, letter = divmod(slot, 26)
+					seq = chr(97 + letter) + seq
+				ret[seq] = num
+		return ret
+
+	def label(self):
+		return {2: "digrams", 3: "trigrams"}.get(self.n, "{}-grams".format(self.n))
+
 def usage():
-	print("freqa [-i <inputfile>] [-s <string>] [-d] [-t] [-f] [-w]")
+	print("freqa [-i <inputfile>] [-s <string>] [-d] [-t] [-n <n>] [-k <top>] [-x] [-c] [-r <dir> [-j <jobs>] [-p <partials>]] [-f] [-w [-m <width>]]")
 	sys.exit(2)
 
 if __name__ == "__main__":
@@ -1,32 +1,226 @@
 #!/usr/bin/env python3
-import sys
+import sys, getopt, os, time, mmap, operator, io, stat
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from array import array
 
-count = 0
 linef = "{0:08X}  {1:s}  |{2:s}|" #line no, hex bytes, ASCII chars
 hexLine = "{} {} {} {} {} {} {} {}  {} {} {} {} {} {} {} {}" #16 hex bytes, string format to accept blanks at EOF
+BLOCK = 1 << 20 #bytes read per block, must be a multiple of 16
+CHUNK = 8 * BLOCK #bytes formatted per task with --jobs, must be a multiple of 16
+ASCII = bytes(b if b < 128 and chr(b).isalnum() else ord(".") for b in range(256)) #byte -> ASCII column char
+HIGH  = bytes(b"0123456789ABCDEF"[b >> 4] for b in range(256)) #byte -> first hex digit
+LOW   = bytes(b"0123456789ABCDEF"[b & 0xF] for b in range(256)) #byte -> second hex digit
 
 def main(args):
 	#Checks for proper argument structure, then calls the translate function
-	if len(args) != 2:
+	try:
+		opts, args = getopt.getopt(args[1:], "s:n:zj:", ["bench", "jobs="])
+		skip, length, squeeze, jobs = 0, None, False, 1
+		for opt, val in opts:
+			if opt == "-s":
+				skip = int(val, 0)
+			elif opt == "-n":
+				length = int(val, 0)
+			elif opt == "-z":
+				squeeze = True
+			elif opt in ("-j", "--jobs"):
+				jobs = int(val)
+	except (getopt.GetoptError, ValueError):
+		usage()
+		sys.exit(2)
+	if len(args) != 1 or skip < 0 or (length is not None and length < 0) or jobs < 1:
 		usage()
 		sys.exit(2)
 	try:
-		with open(args[1], "rb") as fd:
-			translate(fd)
+		if ("--bench", "") in opts:
+			bench(args[0], jobs)
+			return
+		with open(args[0], "rb") as fd:
+			dump(fd, skip, length, squeeze=squeeze, jobs=jobs)
 	except IOError as e:
-		print("Exception raised: " + e)
+		print("Exception raised: " + str(e))
 
-def translate(fd):
-	#reads the file 16 bytes at a time, and prints out the values
-	global count
-	line = fd.read(16)
-	while line:
-		printLine(line)
-		count += 16
-		line = fd.read(16)
+def dump(fd, skip=0, length=None, out=None, squeeze=False, jobs=1):
+	#maps the file and dumps length bytes starting skip bytes in, without reading what comes before
+	#pipes and devices have no size to map, so they are read through a block at a time instead
+	if out is None:
+		out = sys.stdout.buffer
+	info = os.fstat(fd.fileno())
+	regular = stat.S_ISREG(info.st_mode)
+	end = info.st_size if length is None else min(info.st_size, skip + length)
+	if not regular:
+		end = skip + translateBlocks(readBlocks(fd, skip, length), skip, out, squeeze)
+	elif skip < end and jobs > 1:
+		parallel(fd.name, skip, end, out, squeeze, jobs)
+	elif skip < end:
+		with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			view = memoryview(mm)
+			window = view[skip:end]
+			try:
+				translate(window, skip, out, squeeze)
+			finally:
+				window.release()
+				view.release()
+	if squeeze:
+		#like hexdump -C, finish with the end offset so a trailing "*" run has a visible length
+		out.write(b"%08X\n" % max(skip, end))
+		out.flush()
+
+def parallel(path, skip, end, out, squeeze, jobs):
+	#formats CHUNK sized pieces of the window in a process pool and writes them back in file order
+	#at most two chunks per worker are in flight, so memory stays bounded on any size of file
+	starred = False
+	with ProcessPoolExecutor(jobs) as pool:
+		pending = deque()
+		for start in range(skip, end, CHUNK):
+			pending.append(pool.submit(dumpChunk, path, start, min(end, start + CHUNK), skip, squeeze))
+			while len(pending) > 2 * jobs or (pending and start + CHUNK >= end):
+				text = pending.popleft().result()
+				if starred and text.startswith(b"*\n"):
+					#the run was already started at the end of the previous chunk
+					text = text[2:]
+				if text:
+					out.write(text)
+					starred = text.endswith(b"*\n")
+	out.flush()
+
+def dumpChunk(path, start, end, skip, squeeze):
+	#worker side of parallel, returns the formatted rows of [start, end)
+	#the row before start is passed along, so a chunk starting inside a run begins with "*"
+	buf = io.BytesIO()
+	with open(path, "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+		prev = mm[start-16:start] if squeeze and start - skip >= 16 else None
+		translate(mm[start:end], start, buf, squeeze, prev)
+	return buf.getvalue()
+
+def readBlocks(fd, skip, length):
+	#yields BLOCK sized reads of fd from skip on, up to length bytes, only the last one short
+	#skip is seeked past where the input allows it, and read through where it doesn't
+	try:
+		fd.seek(skip)
+	except (OSError, io.UnsupportedOperation):
+		while skip > 0:
+			data = fd.read(min(skip, BLOCK))
+			if not data:
+				return
+			skip -= len(data)
+	left = length
+	while left is None or left > 0:
+		want = BLOCK if left is None else min(BLOCK, left)
+		block = fd.read(want)
+		while block and len(block) < want: #pipes hand back short reads, which would break the rows apart
+			more = fd.read(want - len(block))
+			if not more:
+				break
+			block += more
+		if not block:
+			return
+		if left is not None:
+			left -= len(block)
+		yield block
+		if len(block) < want:
+			return
+
+def translate(data, offset=0, out=None, squeeze=False, prev=None):
+	#writes out the formatted rows of data (bytes or a memoryview) a block at a time, the first line numbered offset
+	#with squeeze, runs of rows identical to the row before them are written as a single "*"
+	#prev is the row just before data, when data continues an earlier call
+	translateBlocks((bytes(data[start:start+BLOCK]) for start in range(0, len(data), BLOCK)), offset, out, squeeze, prev)
+
+def translateBlocks(blocks, offset=0, out=None, squeeze=False, prev=None):
+	#does translate's work over an iterable of blocks, all a multiple of 16 bytes long but the last
+	#returns the number of bytes written out
+	if out is None:
+		out = sys.stdout.buffer
+	starred = False
+	start = 0
+	for block in blocks:
+		if not squeeze:
+			out.write(formatRows(block, offset + start))
+			start += len(block)
+			continue
+		full = len(block) - len(block) % 16
+		for lo, hi, repeat in repeats(block[:full], prev):
+			if not repeat:
+				out.write(formatRows(block[lo:hi], offset + start + lo))
+				starred = False
+			elif not starred:
+				out.write(b"*\n")
+				starred = True
+		if full:
+			prev = block[full-16:full]
+		if full < len(block):
+			out.write(formatRows(block[full:], offset + start + full))
+		start += len(block)
+	out.flush()
+	return start
 
+def repeats(block, prev):
+	#splits whole rows into (start, end, repeat) spans, where a repeat span only holds copies of the row before it
+	#the rows are compared as raw bytes, so squeezed rows never get formatted
+	rows = len(block) // 16
+	if not rows:
+		return
+	if block[:16] == prev and block[16:] == block[:-16]:
+		#the whole block is one run, e.g. a zero filled region
+		yield 0, len(block), True
+		return
+	#flags[row] is 1 when the row matches the one before it, compared as two 8 byte words
+	words = array("Q", block)
+	first, second = words[0::2], words[1::2]
+	if block[:16] != prev and not any(map(operator.eq, first[1:], first[:-1])):
+		yield 0, len(block), False
+		return
+	flags = bytes(map(operator.and_, map(operator.eq, first[1:], first[:-1]), map(operator.eq, second[1:], second[:-1])))
+	flags = (b"\x01" if block[:16] == prev else b"\x00") + flags
+	row = 0
+	while row < rows:
+		repeat = flags[row]
+		end = flags.find(b"\x00" if repeat else b"\x01", row)
+		if end < 0:
+			end = rows
+		yield row * 16, end * 16, bool(repeat)
+		row = end
 
-def printLine(line):
+def formatRows(block, offset):
+	#formats a block of bytes into newline terminated rows, the first row at offset
+	#full rows are laid out column by column with the lookup tables, so the per row cost stays in C
+	full = len(block) - len(block) % 16
+	out = bytearray()
+	if full:
+		digits = max(8, len("%X" % (offset + full - 16)))
+		if max(8, len("%X" % offset)) != digits:
+			#the line number column widens inside this block, split at that line
+			split = (16 ** (digits - 1) - offset + 15) // 16 * 16
+			return formatRows(block[:split], offset) + formatRows(block[split:], offset + split)
+		width = digits + 71 #line no, 2 spaces, 48 hex, 2 spaces, |16 ASCII|, newline
+		row = bytearray(b" " * width)
+		row[digits + 52] = row[width - 2] = ord("|")
+		row[width - 1] = ord("\n")
+		out = row * (full // 16)
+		lines = array("Q", range(offset, offset + full, 16))
+		if sys.byteorder == "little":
+			lines.byteswap() #big endian, so the hex digits come out most significant first
+		lines = lines.tobytes()
+		lineHigh, lineLow = lines.translate(HIGH), lines.translate(LOW)
+		for col, digit in enumerate(range(16 - digits, 16)):
+			out[col::width] = (lineLow if digit & 1 else lineHigh)[digit >> 1::8]
+		data = block[:full]
+		high, low, asc = data.translate(HIGH), data.translate(LOW), data.translate(ASCII)
+		for idx in range(16):
+			col = digits + 2 + 3 * idx + (idx >= 8)
+			out[col::width] = high[idx::16]
+			out[col + 1::width] = low[idx::16]
+			out[digits + 53 + idx::width] = asc[idx::16]
+	tail = block[full:]
+	if tail:
+		#pad out the hex column for the EOF case
+		hexStrs = ["%02X" % byte for byte in tail] + ["  "] * (16 - len(tail))
+		out += (linef.format(offset + full, hexLine.format(*hexStrs), tail.translate(ASCII).decode("ascii")) + "\n").encode("ascii")
+	return out
+
+def printLine(line, offset):
 	#prints the given line of bytes in proper format
 	ascArr = [None] * len(line)
 	hexStrs  = [None] * 16
@@ -47,9 +241,42 @@ def printLine(line):
 		for i in range(len(line)-1, 16):
 			hexStrs[i] = "  "
 	#Setup is complete, print with pre-made format strings
-	lineVal = linef.format(count, hexLine.format(*hexStrs), ''.join(ascArr))
+	lineVal = linef.format(offset, hexLine.format(*hexStrs), ''.join(ascArr))
 	print(lineVal)
 
+def printLines(fd):
+	#the original line at a time path, reads 16 bytes and prints each row
+	offset = 0
+	line = fd.read(16)
+	while line:
+		printLine(line, offset)
+		offset += 16
+		line = fd.read(16)
+
+def bench(path, jobs=1):
+	#times the line at a time path against the block path, and the process pool when jobs > 1
+	#output goes to devnull
+	size = os.path.getsize(path)
+	results = []
+	stdout = sys.stdout
+	names = ["printLine", "translate"]
+	if jobs > 1:
+		names.append("jobs={}".format(jobs))
+	for name in names:
+		with open(path, "rb") as fd, open(os.devnull, "w") as null:
+			start = time.perf_counter()
+			if name == "printLine":
+				sys.stdout = null
+				try:
+					printLines(fd)
+				finally:
+					sys.stdout = stdout
+			else:
+				dump(fd, out=null.buffer, jobs=1 if name == "translate" else jobs)
+			elapsed = time.perf_counter() - start
+		results.append(elapsed)
+		print("{:>10s}: {:8.3f}s {:10.2f} MB/s {:8.1f}x".format(name, elapsed, size / elapsed / 1e6 if elapsed else 0, results[0] / elapsed if elapsed else 0))
+
 def find(char, string):
 	#Finds all instances of char in the given string
 	ret = []
@@ -60,7 +287,7 @@ def find(char, string):
 
 def usage():
 	#mandatory input file
-	print("hexdump <inputfile>")
+	print("hexdump [-s <skip>] [-n <length>] [-z] [-j|--jobs <n>] [--bench] <inputfile>")
 
 if __name__ == "__main__":
 	main(sys.argv)
@@ -4,8 +4,14 @@ Author: Zach Greenhalge
 Parses the MFT entries in an NTFS system
 """
 
-import sys, math, traceback, time, random
-from struct import unpack
+import sys, os, math, traceback, time, random, tempfile
+from collections import namedtuple
+from struct import unpack, unpack_from, pack_into
+
+CHUNK = 4 << 20 #bytes of the MFT read at a time by scan
+FIXUP_STRIDE = 512 #update sequence entries cover 512 byte strides whatever the sector size
+FILETIME_EPOCH = 116444736000000000 #100ns intervals from 1601 to 1970
+Record = namedtuple("Record", "entry seq flags base parent size mtime name") #what scan streams for each FILE record
 
 bytes_per_sector    = -1
 sectors_per_cluster = -1
@@ -19,8 +25,8 @@ class MFTEntry:
 	"""Parses an MFT entry header and creates MFTAttribute instances for all attributes in the entry"""
 	printStr = "Sequence: {}\n$LogFile Sequence Number: {}\n{}\nUsed Size: {}\nAllocated Size: {}\n"
 
-	def __init__(self, start, fd):
-		self.offset 		= bytes_per_sector * sectors_per_cluster * start
+	def __init__(self, start, fd, offset=None):
+		self.offset 		= bytes_per_sector * sectors_per_cluster * start if offset is None else offset
 		fd.seek(self.offset, 0)
 		if debug:
 			print("$MFT starts at: {0:} ({0:X})".format(self.offset))
@@ -80,6 +86,12 @@ class MFTEntry:
 	def add_attribute(self, attribute):
 		self.attributes.append(attribute)
 
+	def get_attribute(self, type_id):
+		for attr in self.attributes:
+			if attr.type_ID == type_id:
+				return attr
+		return None
+
 
 class MFTAttribute:
 	"""Parses an attribute in an MFTEntry"""
@@ -169,12 +181,6 @@ class MFTAttribute:
 
 		parent.new_attribute(self.next)
 
-	def get_attribute(self, type_id):
-		for attr in self.attributes:
-			if attr.type_ID == type_id:
-				return attr
-		return None
-
 	def print_header(self):
 		print("Type: {} ({}) NameLen: ({}) {}   size: {}".format(self.type_name, self.type_ID, self.name_len, self.residentStr, self.length))
 		if debug:
@@ -334,8 +340,47 @@ class MFTAttribute:
 				padLength = 8-len(bites)
 			return unpack("<q", bites + (pad * padLength))[0]
 
-def main():
+def read_boot(fd):
+	"""Reads the volume geometry out of the boot sector into the module globals"""
 	global bytes_per_sector, sectors_per_cluster, total_sectors, MFT_start_cluster, size_MFT_entry, size_index_record
+	fd.seek(0)
+	fd.read(3) #(3 bytes) - assembly to jump to boot code
+	fd.read(8) #(8 bytes) - OEM name of drive
+	bytes_per_sector    = unpack("<H", fd.read(2))[0]
+	sectors_per_cluster = int(unpack("<B", fd.read(1))[0])
+	fd.read(2) #(2 bytes) - reserved sectors [must be 0, according to Microsoft]
+	fd.read(5) #(5 bytes) - unused
+	fd.read(1) #(1 byte ) - media descriptor for dirve
+	fd.read(2) #(2 bytes) - unused [must be 0: Microsoft]
+	fd.read(8) #(8 bytes) - unused
+	fd.read(4) #(4 bytes) - unused [must be 0: Microsoft]
+	fd.read(4) #(4 bytes) - unused
+	total_sectors       = unpack("<Q", fd.read(8))[0]
+	MFT_start_cluster   = unpack("<Q", fd.read(8))[0]
+	fd.read(8) #(8 bytes) - start cluster of MFT mirror $DATA attribute
+	size_MFT_entry      = unpack("<b", fd.read(1))[0] # clusters per file record (MFT entry)
+	fd.read(3) #(3 bytes) - unused
+	size_index_record   = unpack("<B", fd.read(1))[0] # clusters per index block
+	fd.read(3) #(3 bytes) - unused
+	fd.read(8) #(8 bytes) - serial number of drive
+
+	if size_MFT_entry < 0: # 2^-n bytes when a record is smaller than a cluster
+		size_MFT_entry = int(math.pow(2, abs(size_MFT_entry)))
+	else:
+		size_MFT_entry = size_MFT_entry * bytes_per_sector * sectors_per_cluster
+
+def main():
+	if len(sys.argv) >= 2 and sys.argv[1] == "--bench":
+		bench(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+		return
+	if len(sys.argv) == 3 and sys.argv[1] == "--scan":
+		with open(sys.argv[2], "rb") as fd:
+			read_boot(fd)
+			extents, data_size = mft_extents(fd)
+			out = sys.stdout
+			for rec in scan(fd, extents, data_size):
+				out.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(rec.entry, rec.seq, rec.flags, rec.base, rec.parent, rec.size, rec.mtime, rec.name))
+		return
 	if len(sys.argv) < 2 or len(sys.argv) > 3:
 		usage()
 		sys.exit(2)
@@ -344,28 +389,7 @@ def main():
 	else:
 		entry_num = -1
 	with open(sys.argv[1], "rb") as fd:
-		fd.read(3) #(3 bytes) - assembly to jump to boot code
-		fd.read(8) #(8 bytes) - OEM name of drive
-		bytes_per_sector    = unpack("<H", fd.read(2))[0]
-		sectors_per_cluster = int(unpack("<B", fd.read(1))[0])
-		fd.read(2) #(2 bytes) - reserved sectors [must be 0, according to Microsoft]
-		fd.read(5) #(5 bytes) - unused
-		fd.read(1) #(1 byte ) - media descriptor for dirve
-		fd.read(2) #(2 bytes) - unused [must be 0: Microsoft]
-		fd.read(8) #(8 bytes) - unused
-		fd.read(4) #(4 bytes) - unused [must be 0: Microsoft]
-		fd.read(4) #(4 bytes) - unused
-		total_sectors       = unpack("<Q", fd.read(8))[0]
-		MFT_start_cluster   = unpack("<Q", fd.read(8))[0]
-		fd.read(8) #(8 bytes) - start cluster of MFT mirror $DATA attribute
-		size_MFT_entry      = unpack("<b", fd.read(1))[0] # clusters per file record (MFT entry)
-		fd.read(3) #(3 bytes) - unused
-		size_index_record   = unpack("<B", fd.read(1))[0] # clusters per index block
-		fd.read(3) #(3 bytes) - unused
-		fd.read(8) #(8 bytes) - serial number of drive
-		
-		if size_MFT_entry < 0:
-			size_MFT_entry = int(math.pow(2, abs(size_MFT_entry)))
+		read_boot(fd)
 		if debug:
 			print("Bytes per sector: {}".format(bytes_per_sector))
 			print("MFT start: {}".format(MFT_start_cluster))
@@ -377,14 +401,237 @@ def main():
 		data = mft.get_attribute(128)
 		if data == None:
 			raise Exception("Data attribute does not exist for entry {}".format(mft.seq_value))
+		extents, data_size = mft_extents(fd)
 		if entry_num < 0:
-			entry_num = random.randint(16, math.ceil(mft.data_size/size_MFT_entry))
-		entry_start_cluster, bytes_deep = divmod(((entry_num-1)*size_MFT_entry)/(sectors_per_cluster*bytes_per_sector))
-
-
+			entry_num = random.randint(16, data_size // size_MFT_entry - 1)
+		print("Entry {}".format(entry_num))
+		MFTEntry(0, fd, entry_offset(extents, entry_num))
+
+def mft_extents(fd):
+	"""Returns the runs of the $MFT's own $DATA as (start cluster, clusters) pairs, and the size of that data in bytes
+	Read from entry 0, the $MFT record, which is always at MFT_start_cluster"""
+	cluster = bytes_per_sector * sectors_per_cluster
+	fd.seek(MFT_start_cluster * cluster)
+	raw = bytearray(fd.read(size_MFT_entry))
+	if raw[0:4] != b'FILE' or not apply_fixups(raw, 0):
+		raise Exception("Entry 0 of the MFT at cluster {} is not a valid FILE record".format(MFT_start_cluster))
+	for type_ID, offset in attributes(raw, 0):
+		if type_ID == 128 and raw[offset+8] and raw[offset+9] == 0: #the unnamed, non-resident $DATA
+			runs = runlist(raw, offset + unpack_from("<H", raw, offset+32)[0], offset + unpack_from("<L", raw, offset+4)[0])
+			return runs, unpack_from("<Q", raw, offset+48)[0]
+	raise Exception("Data attribute does not exist for the $MFT")
+
+def entry_offset(extents, entry_num):
+	"""Byte offset in the volume of MFT entry entry_num, found through the $MFT's runs"""
+	cluster = bytes_per_sector * sectors_per_cluster
+	pos = entry_num * size_MFT_entry
+	for start, length in extents:
+		if pos < length * cluster:
+			if start is None:
+				raise Exception("Entry {} is in a sparse part of the MFT".format(entry_num))
+			return start * cluster + pos
+		pos -= length * cluster
+	raise Exception("Entry {} is past the end of the MFT".format(entry_num))
+
+def runlist(raw, offset, end):
+	"""Decodes the runlist at offset into (start cluster, clusters) pairs, with None as the start of a sparse run
+	Runs are kept whole rather than expanded into a cluster each"""
+	runs = []
+	start = 0
+	while offset < end and raw[offset]:
+		len_runlen = raw[offset] & 0x0F
+		len_runoff = raw[offset] >> 4
+		offset += 1
+		length = int.from_bytes(raw[offset:offset+len_runlen], "little")
+		offset += len_runlen
+		if len_runoff:
+			start += int.from_bytes(raw[offset:offset+len_runoff], "little", signed=True)
+			runs.append((start, length))
+		else:
+			runs.append((None, length))
+		offset += len_runoff
+	return runs
+
+def apply_fixups(raw, start):
+	"""Puts back the last two bytes of each sector of the record at start from its update sequence array
+	Returns False for a record with a torn write, where a stride doesn't end in the update sequence number"""
+	fixup_offset, fixup_entry = unpack_from("<HH", raw, start+4)
+	if (fixup_entry - 1) * FIXUP_STRIDE != size_MFT_entry or fixup_offset + 2*fixup_entry > size_MFT_entry:
+		return False
+	usn = start + fixup_offset
+	for i in range(1, fixup_entry):
+		tail = start + i * FIXUP_STRIDE - 2
+		if raw[tail:tail+2] != raw[usn:usn+2]:
+			return False
+		raw[tail:tail+2] = raw[usn+2*i:usn+2*i+2]
+	return True
+
+def attributes(raw, start):
+	"""Yields the type and offset of each attribute of the record at start"""
+	end = start + min(unpack_from("<L", raw, start+24)[0], size_MFT_entry)
+	offset = start + unpack_from("<H", raw, start+20)[0]
+	while offset + 16 <= end:
+		type_ID, length = unpack_from("<LL", raw, offset)
+		if type_ID == 0xFFFFFFFF or length < 16 or offset + length > end:
+			break
+		yield type_ID, offset
+		offset += length
+
+def parse_record(raw, start, entry):
+	"""Returns the Record for the FILE record at start in raw, or None for an unused or damaged slot
+	Only the fields scan streams are read: the best $FILE_NAME, the unnamed $DATA size and the $STANDARD_INFORMATION mtime"""
+	if raw[start:start+4] != b'FILE' or not apply_fixups(raw, start):
+		return None
+	seq, flags = unpack_from("<H", raw, start+16)[0], unpack_from("<H", raw, start+22)[0]
+	base = unpack_from("<Q", raw, start+32)[0] & 0xFFFFFFFFFFFF
+	parent = size = mtime = name = None
+	namespace = -1
+	for type_ID, offset in attributes(raw, start):
+		nonresident = raw[offset+8]
+		if type_ID == 16 and not nonresident:
+			content = offset + unpack_from("<H", raw, offset+20)[0]
+			mtime = (unpack_from("<Q", raw, content+8)[0] - FILETIME_EPOCH) // 10000000
+		elif type_ID == 48 and not nonresident and namespace in (-1, 2): #any name over none, a long name over the DOS 8.3 one
+			content = offset + unpack_from("<H", raw, offset+20)[0]
+			parent = unpack_from("<Q", raw, content)[0] & 0xFFFFFFFFFFFF
+			namespace = raw[content+65]
+			name = bytes(raw[content+66:content+66+2*raw[content+64]]).decode("utf-16-le", "replace")
+		elif type_ID == 128 and raw[offset+9] == 0:
+			size = unpack_from("<Q", raw, offset+48)[0] if nonresident else unpack_from("<L", raw, offset+16)[0]
+	return Record(entry, seq, flags, base, parent, size, mtime, name)
+
+def read_extents(fd, extents, data_size):
+	"""Yields the MFT's data in order as bytearrays of up to CHUNK bytes, each from one large read, zeros for sparse runs"""
+	cluster = bytes_per_sector * sectors_per_cluster
+	left = data_size
+	for start, length in extents:
+		length = min(length * cluster, left)
+		left -= length
+		if start is not None:
+			fd.seek(start * cluster)
+		while length > 0:
+			block = bytearray(min(CHUNK, length))
+			if start is not None and fd.readinto(block) != len(block):
+				raise Exception("MFT run at cluster {} runs past the end of the image".format(start))
+			length -= len(block)
+			yield block
+		if left <= 0:
+			break
+
+def scan(fd, extents, data_size):
+	"""Yields a Record for every in use or deleted FILE record in the MFT, reading it an extent at a time
+	An entry split across two runs, possible when clusters are smaller than entries, is carried over to the next block"""
+	entry = 0
+	carry = b''
+	for block in read_extents(fd, extents, data_size):
+		if carry:
+			block = carry + block
+		usable = len(block) - len(block) % size_MFT_entry
+		for start in range(0, usable, size_MFT_entry):
+			rec = parse_record(block, start, entry)
+			if rec is not None:
+				yield rec
+			entry += 1
+		carry = block[usable:]
+
+def synthetic(path, entries, cluster=4096, entry_size=1024, sector=512):
+	"""Writes an NTFS image whose MFT has entries FILE records, split into three runs that are out of order on disk
+	Only the boot sector fields and record layout read here are filled in"""
+	strides = entry_size // FIXUP_STRIDE
+	clusters = (entries * entry_size + cluster - 1) // cluster
+	first, second = clusters // 3, clusters // 3
+	third = clusters - first - second
+	runs = [(16, first), (16 + first + third + 64, second), (16 + first + 32, third)] #the last run sits between the others
+	size = (runs[1][0] + second) * cluster
+	with open(path, "wb") as fd:
+		fd.truncate(size)
+		boot = bytearray(sector)
+		boot[3:11] = b"NTFS    "
+		pack_into("<HB", boot, 11, sector, cluster // sector)
+		pack_into("<QQQb", boot, 40, size // sector, runs[0][0], 0, -int(math.log2(entry_size)))
+		fd.write(boot)
+		record = bytearray(entry_size)
+		name_attr = (48 + 2 * (strides + 1) + 7) & ~7 #first attribute, $STANDARD_INFORMATION, just past the update sequence array
+		for entry in range(entries):
+			record[:] = bytes(entry_size)
+			pack_into("<4sHHQHHHHLLQH", record, 0, b'FILE', 48, strides + 1, 0, 1, 1, name_attr, 1, 0, entry_size, 0, 4)
+			offset = name_attr
+			pack_into("<LLBBHHHLH", record, offset, 16, 96, 0, 0, 0, 0, 0, 72, 24)
+			pack_into("<QQQQ", record, offset + 24, *[FILETIME_EPOCH + (1500000000 + entry) * 10000000] * 4)
+			offset += 96
+			name = "file{}.txt".format(entry).encode("utf-16-le")
+			length = (24 + 66 + len(name) + 7) & ~7
+			pack_into("<LLBBHHHLH", record, offset, 48, length, 0, 0, 0, 0, 1, 66 + len(name), 24)
+			pack_into("<QQQQQQQLLBB", record, offset + 24, 5 | (1 << 48), *[0] * 4, 0, entry, 0x20, 0, len(name) // 2, 1)
+			record[offset+24+66:offset+24+66+len(name)] = name
+			offset += length
+			if entry == 0: #the $MFT's own $DATA, pointing at the runs
+				runlist_bytes = bytearray()
+				prev = 0
+				for start, length in runs:
+					delta = (start - prev).to_bytes(4, "little", signed=True)
+					runlist_bytes += bytes([0x44]) + length.to_bytes(4, "little") + delta
+					prev = start
+				runlist_bytes += b'\x00'
+				length = (64 + len(runlist_bytes) + 7) & ~7
+				pack_into("<LLBBHHHQQHHLQQQ", record, offset, 128, length, 1, 0, 0, 0, 2, 0, clusters - 1, 64, 0, 0, clusters * cluster, entries * entry_size, entries * entry_size)
+				record[offset+64:offset+64+len(runlist_bytes)] = runlist_bytes
+			else:
+				length = 24 + 8
+				pack_into("<LLBBHHHLH", record, offset, 128, length, 0, 0, 0, 0, 2, entry, 24)
+			offset += length
+			pack_into("<LL", record, offset, 0xFFFFFFFF, 0)
+			pack_into("<L", record, 24, offset + 8)
+			for i in range(1, strides + 1): #save the stride tails into the update sequence array and stamp the USN over them
+				tail = i * FIXUP_STRIDE - 2
+				record[48 + 2*i:50 + 2*i] = record[tail:tail+2]
+				record[tail:tail+2] = b'\x01\x00'
+			record[48:50] = b'\x01\x00'
+			done = 0
+			while done < entry_size: #a cluster at a time, as a record may straddle two runs
+				disk, within = divmod(entry * entry_size + done, cluster)
+				for start, length in runs:
+					if disk < length:
+						break
+					disk -= length
+				piece = min(entry_size - done, cluster - within)
+				fd.seek((start + disk) * cluster + within)
+				fd.write(record[done:done + piece])
+				done += piece
+
+def bench(entries=100000):
+	"""Times scan over a synthetic image, against reading and parsing entries one at a time with MFTEntry"""
+	global debug
+	fd, path = tempfile.mkstemp(suffix=".ntfs")
+	os.close(fd)
+	try:
+		synthetic(path, entries)
+		with open(path, "rb") as fd:
+			read_boot(fd)
+			start = time.perf_counter()
+			extents, data_size = mft_extents(fd)
+			count = sum(1 for rec in scan(fd, extents, data_size))
+			elapsed = time.perf_counter() - start
+			print("{:>8s}: {} entries in {:.3f}s, {:.0f} entries/s, {} runs".format("scan", count, elapsed, count / elapsed, len(extents)))
+			sample = min(entries, 1000)
+			stdout, verbose, debug = sys.stdout, debug, False
+			try:
+				with open(os.devnull, "w") as null:
+					sys.stdout = null
+					start = time.perf_counter()
+					for entry in range(sample):
+						MFTEntry(0, fd, entry_offset(extents, entry))
+					old = time.perf_counter() - start
+			finally:
+				sys.stdout, debug = stdout, verbose
+			print("{:>8s}: {} entries in {:.3f}s, {:.0f} entries/s".format("MFTEntry", sample, old, sample / old))
+	finally:
+		os.remove(path)
 
 def usage():
 	print("ntfs_mft <path> [entry #]")
+	print("ntfs_mft --scan <path>")
+	print("ntfs_mft --bench [entries]")
 
 def hex_from_bytes(data):
 	return "".join("{:02X}".format(i) for i in data)
@@ -4,12 +4,46 @@ Provides functionality for polynomial arithmetic functions, including adding and
 Author: Zach Greenhalge
 """
 
-import sys
+import sys, time, random
+try:
+	import numpy
+except ImportError:
+	numpy = None #array operations fall back to lists
+
+KARATSUBA = 32 #mult falls back to schoolbook below this many coefficients
+MAXTABLE = 16 #largest m for which a field keeps exp/log tables, 2 lists of 2^m entries
+FIELDS = {} #irreducible polynomial -> GField, so tables are built once per polynomial
 
 def main(args):
+	if args and args[0] == "--bench":
+		bench(to_int([int(i) for i in args[1]]) if len(args) > 1 else 0x11d)
+		return
+	if args and args[0] == "--bench-mult":
+		bench_mult()
+		return
 	if len(args) < 3:
 		usage()
 		sys.exit(2)
+	if args[0] in ("-gi", "-ge"): #the second argument is the modulus or an exponent, not a polynomial to line up
+		p1 = [int(i) for i in args[1]]
+		if args[0] == "-ge" and len(args) < 4:
+			print("Please provide an irreducible polynomial")
+			sys.exit(2)
+		p3 = [int(i) for i in args[-1]]
+		try:
+			if args[0] == "-gi":
+				print("({})^-1 mod ({}) = ({}) in GF(2^m)".format(pretty_poly(p1), pretty_poly(p3), pretty_poly(g_inv(p1, p3))))
+			else:
+				try:
+					e = int(args[2])
+				except ValueError:
+					usage()
+					sys.exit(2)
+				print("({})^{} mod ({}) = ({}) in GF(2^m)".format(pretty_poly(p1), e, pretty_poly(p3), pretty_poly(g_pow(p1, e, p3))))
+		except ZeroDivisionError:
+			print("({}) has no inverse mod ({})".format(pretty_poly(p1), pretty_poly(p3)))
+			sys.exit(1)
+		return
 	p1 = [int(i) for i in args[1]]
 	p2 = [int(i) for i in args[2]]
 	p1, p2 = lenshift(p1, p2) #ensure that polys re same length
@@ -26,7 +60,13 @@ def main(args):
 			sys.exit(2)
 		else:
 			p3 = [int(i) for i in args[3]]
-		print("({}) * ({}) mod ({}) ~= ({}) in GF(2^m)".format(pretty_poly(p1), pretty_poly(p2), pretty_poly(p3), pretty_poly(g_mult(p1, p2, p3)[1])))
+		p = to_int(p3)
+		try:
+			gf = field(p)
+			res = to_poly(gf.mult(b_mod(to_int(p1), p), b_mod(to_int(p2), p)))
+		except ValueError: #too big for tables, or not irreducible
+			res = g_mult(p1, p2, p3)[1]
+		print("({}) * ({}) mod ({}) ~= ({}) in GF(2^m)".format(pretty_poly(p1), pretty_poly(p2), pretty_poly(p3), pretty_poly(res)))
 	elif args[0] == "-a":
 		print("({}) + ({}) = ({})".format(pretty_poly(p1), pretty_poly(p2), pretty_poly(add(p1, p2))))
 	elif args[0] == "-s":
@@ -45,6 +85,10 @@ def lenshift(poly1, poly2):
 
 def usage():
 	print("gfield [-a][-ga][-s][-m][-d][-gm] poly1 poly2 [poly3]")
+	print("gfield -gi poly1 poly3")
+	print("gfield -ge poly1 exponent poly3")
+	print("gfield --bench [poly3]")
+	print("gfield --bench-mult")
 
 def add(a, b):
 	c = []
@@ -62,26 +106,345 @@ def sub(a, b):
 
 def g_add(a, b):
 	"""Add two polynomials in GF(2^m)"""
-	c = []
-	idx = 0
-	for c1, c2 in zip(a, b):
-		c.append((c1 + c2) % 2)
-	return c
+	return to_poly(b_add(to_int(a), to_int(b)), max(len(a), len(b)))
 
 def g_mult(a, b, p):
-	"""Multiply two polynomials given the irreducible polynomial of a GF"""
-	c = [i % 2 for i in mult(a, b)]
-	c, p = lenshift(c, p)
-	return div(c, p)
+	"""Multiply two polynomials given the irreducible polynomial of a GF
+	Returns the quotient and remainder of the product by p, the remainder being the field element"""
+	q, r = b_divmod(b_mult(to_int(a), to_int(b)), to_int(p))
+	return to_poly(q), to_poly(r)
+
+def g_inv(a, p):
+	"""Invert a polynomial in the GF given by the irreducible polynomial p, raising ZeroDivisionError if it has no inverse"""
+	p = to_int(p)
+	a = b_mod(to_int(a), p)
+	try:
+		return to_poly(field(p).inv(a))
+	except ValueError: #no tables for this p
+		return to_poly(b_inv(a, p))
+
+def g_pow(a, e, p):
+	"""Raise a polynomial to the integer power e in the GF given by the irreducible polynomial p"""
+	p = to_int(p)
+	a = b_mod(to_int(a), p)
+	try:
+		return to_poly(field(p).pow(a, e))
+	except ValueError:
+		return to_poly(b_pow(a, e, p))
+
+# GF(2) polynomials as bitmask ints, bit i holding the coefficient of x^i.
+# Adding is XOR and multiplying is shift-and-XOR, so whole polynomials are handled a machine word at a time
+
+def to_int(poly):
+	"""Turn a poly array into a bitmask int, coefficients taken mod 2"""
+	ret = 0
+	for coeff in poly:
+		ret = (ret << 1) | (int(coeff) & 1)
+	return ret
+
+def to_poly(num, length=1):
+	"""Turn a bitmask int into a poly array of at least length coefficients"""
+	return [int(bit) for bit in format(num, "0{}b".format(length))]
+
+def b_add(a, b):
+	"""Add two bitmask polynomials over GF(2)"""
+	return a ^ b
+
+def b_mult(a, b):
+	"""Carry-less multiply of two bitmask polynomials, taking the smaller one 4 bits at a time"""
+	if a.bit_length() < b.bit_length():
+		a, b = b, a
+	window = [0] * 16 #a times every 4 bit polynomial
+	for i in range(1, 16):
+		window[i] = (window[i >> 1] << 1) ^ (a if i & 1 else 0)
+	ret = 0
+	shift = 0
+	while b:
+		ret ^= window[b & 15] << shift
+		b >>= 4
+		shift += 4
+	return ret
+
+def b_divmod(a, b):
+	"""Divide two bitmask polynomials, returning the quotient and remainder"""
+	dB = b.bit_length() - 1
+	if dB < 0: raise ZeroDivisionError
+	q = 0
+	shift = a.bit_length() - 1 - dB
+	while shift >= 0:
+		q |= 1 << shift
+		a ^= b << shift
+		shift = a.bit_length() - 1 - dB
+	return q, a
+
+def b_mod(a, p):
+	"""Reduce a bitmask polynomial by the irreducible polynomial p"""
+	return b_divmod(a, p)[1]
+
+def b_gmult(a, b, p):
+	"""Multiply two bitmask polynomials in the GF given by the irreducible polynomial p"""
+	return b_mod(b_mult(a, b), p)
+
+def b_inv(a, p):
+	"""Invert a bitmask polynomial mod p with the extended Euclidean algorithm
+	Keeps s with s * a = r mod p for each remainder r, so s is the inverse once r reaches 1"""
+	r0, r1 = p, b_mod(a, p)
+	s0, s1 = 0, 1
+	while r1:
+		q, r = b_divmod(r0, r1)
+		r0, r1 = r1, r
+		s0, s1 = s1, s0 ^ b_mult(q, s1)
+	if r0 != 1: raise ZeroDivisionError
+	return b_mod(s0, p)
+
+def b_pow(a, e, p):
+	"""Raise a bitmask polynomial to the integer power e mod p by square and multiply, inverting first for negative e"""
+	if e < 0:
+		a, e = b_inv(a, p), -e
+	ret = b_mod(1, p)
+	for bit in format(e, "b"):
+		ret = b_gmult(ret, ret, p)
+		if bit == "1":
+			ret = b_gmult(ret, a, p)
+	return ret
+
+def b_gcd(a, b):
+	"""Greatest common divisor of two bitmask polynomials"""
+	while b:
+		a, b = b, b_mod(a, b)
+	return a
+
+def irreducible(p):
+	"""Rabin's test: p of degree m is irreducible when x^(2^m) = x mod p and x^(2^(m/q)) - x shares no factor with p for each prime q dividing m"""
+	m = p.bit_length() - 1
+	if m < 1:
+		return False
+	squares = [b_mod(2, p)] #x^(2^k) mod p
+	for k in range(m):
+		squares.append(b_gmult(squares[-1], squares[-1], p))
+	if squares[m] != squares[0]:
+		return False
+	for q in range(2, m + 1):
+		if m % q == 0 and all(q % r for r in range(2, q)):
+			if b_gcd(squares[m // q] ^ squares[0], p) != 1:
+				return False
+	return True
+
+class GField:
+	"""GF(2^m) for m up to MAXTABLE, with elements as bitmask ints below 2^m
+	Every nonzero element is a power of a generator, so multiplying and dividing are adding and subtracting logs"""
+	def __init__(self, p):
+		self.p = p
+		self.m = p.bit_length() - 1
+		if self.m > MAXTABLE:
+			raise ValueError("GF(2^{}) is too large for tables".format(self.m))
+		if not irreducible(p):
+			raise ValueError("({}) is not irreducible".format(pretty_poly(to_poly(p))))
+		self.order = (1 << self.m) - 1
+		for g in range(1, self.order + 1):
+			exp = self.powers(g)
+			if exp:
+				break
+		self.generator = g
+		self.log = [0] * (self.order + 1)
+		for i, e in enumerate(exp):
+			self.log[e] = i
+		self.exp = exp + exp #doubled so a sum or difference of logs needs no mod
+		self.nlog = self.nexp = None #numpy copies, built on first use
+
+	def tables(self):
+		"""numpy copies of the tables, with log(0) pointing past the doubled exp into zeros
+		so a product with 0 comes out of the same gather as every other product"""
+		if self.nexp is None:
+			self.nlog = numpy.array(self.log, dtype=numpy.intp)
+			self.nlog[0] = 2 * self.order
+			self.nexp = numpy.array(self.exp + [0] * (2 * self.order + 1), dtype=numpy.uint8 if self.m <= 8 else numpy.uint16)
+		return self.nlog, self.nexp
+
+	def powers(self, g):
+		"""Returns g^0 .. g^(order-1), or None when g generates a smaller subgroup"""
+		ret = [1]
+		e = g
+		while e != 1:
+			ret.append(e)
+			e = b_gmult(e, g, self.p)
+		return ret if len(ret) == self.order else None
+
+	def add(self, a, b):
+		return a ^ b
+
+	def mult(self, a, b):
+		if a == 0 or b == 0:
+			return 0
+		return self.exp[self.log[a] + self.log[b]]
+
+	def inv(self, a):
+		if a == 0: raise ZeroDivisionError
+		return self.exp[self.order - self.log[a]]
+
+	def pow(self, a, e):
+		if a == 0:
+			if e < 0: raise ZeroDivisionError
+			return 0 if e else 1
+		return self.exp[self.log[a] * e % self.order]
+
+	def div(self, a, b):
+		if b == 0: raise ZeroDivisionError
+		if a == 0:
+			return 0
+		return self.exp[self.log[a] - self.log[b] + self.order]
+
+	def mult_array(self, a, b):
+		"""Multiply arrays of elements elementwise, or an array by a single element b"""
+		if numpy is None:
+			if isinstance(b, int):
+				return [self.mult(x, b) for x in a]
+			return [self.mult(x, y) for x, y in zip(a, b)]
+		log, exp = self.tables()
+		return exp[log[numpy.asarray(a)] + log[numpy.asarray(b)]]
+
+def field(p):
+	"""Returns the cached GField for the irreducible bitmask polynomial p, raising ValueError if there can be none"""
+	if p not in FIELDS:
+		FIELDS[p] = GField(p)
+	return FIELDS[p]
+
+def g_add_array(a, b):
+	"""Add arrays of GF(2^m) elements elementwise, or an array and a single element b"""
+	if numpy is not None:
+		return numpy.bitwise_xor(a, b)
+	if isinstance(b, int):
+		return [x ^ b for x in a]
+	return [x ^ y for x, y in zip(a, b)]
+
+def g_mult_array(a, b, p):
+	"""Multiply arrays of elements, already reduced below 2^m, in the GF given by the irreducible bitmask polynomial p
+	b may be a single element. Small fields gather from the exp/log tables; up to GF(2^32) numpy multiplies
+	a bit of b at a time over the whole array, and anything larger loops over b_gmult"""
+	m = p.bit_length() - 1
+	if m <= MAXTABLE and (p in FIELDS or irreducible(p)):
+		return field(p).mult_array(a, b)
+	if numpy is not None and m <= 32: #products stay below 2^63
+		a = numpy.asarray(a, dtype=numpy.uint64)
+		b = numpy.asarray(b, dtype=numpy.uint64)
+		ret = numpy.zeros(numpy.broadcast(a, b).shape, dtype=numpy.uint64)
+		for i in range(m):
+			ret ^= (a << i) * ((b >> i) & 1)
+		for i in range(2 * m - 2, m - 1, -1):
+			ret ^= ((ret >> i) & 1) * numpy.uint64(p << (i - m))
+		return ret
+	if numpy is not None: #numpy integers have no bit_length, and wrap past 2^64
+		a = numpy.asarray(a).tolist()
+		b = numpy.asarray(b).tolist()
+	if isinstance(b, int):
+		return [b_gmult(x, b, p) for x in a]
+	return [b_gmult(x, y, p) for x, y in zip(a, b)]
+
+def bench(p, n=1 << 16):
+	"""Elements per second multiplying n random pairs in the GF given by p, one call at a time against the array API"""
+	m = p.bit_length() - 1
+	a = [random.randrange(1 << m) for i in range(n)]
+	b = [random.randrange(1 << m) for i in range(n)]
+	pl = to_poly(p)
+	names = ["g_mult", "b_gmult", "GField.mult", "g_mult_array"]
+	results = []
+	print("GF(2^{}) mod ({}), {} elements".format(m, pretty_poly(pl), n))
+	for name in names:
+		count = n
+		start = time.perf_counter()
+		if name == "g_mult":
+			count = n // 16 #the list path is slow enough to sample
+			for x, y in zip(a[:count], b[:count]):
+				g_mult(to_poly(x), to_poly(y), pl)
+		elif name == "b_gmult":
+			for x, y in zip(a, b):
+				b_gmult(x, y, p)
+		elif name == "GField.mult":
+			if m > MAXTABLE or not irreducible(p):
+				continue
+			gf = field(p) #table build is outside the timing below
+			start = time.perf_counter()
+			for x, y in zip(a, b):
+				gf.mult(x, y)
+		else:
+			if numpy is not None and m <= 32: #larger fields take the b_gmult loop over plain lists
+				x, y = numpy.array(a, dtype=numpy.uint64), numpy.array(b, dtype=numpy.uint64)
+				if m <= MAXTABLE:
+					g_mult_array(x, y, p) #build the tables once
+				start = time.perf_counter()
+				g_mult_array(x, y, p)
+			else:
+				g_mult_array(a, b, p)
+		elapsed = time.perf_counter() - start
+		results.append(count / elapsed if elapsed else 0)
+		print("{:>12s}: {:14.0f} elements/s {:10.1f}x".format(name, results[-1], results[-1] / results[0]))
+
+def bench_mult(degrees=(64, 256, 1024, 4096, 16384)):
+	"""Seconds for schoolbook, Karatsuba mult and div on random 0/1 polynomials of each degree"""
+	print("{:>8s} {:>10s} {:>10s} {:>10s}".format("degree", "schoolbook", "mult", "div"))
+	for deg in degrees:
+		a = [1] + [random.randint(0, 1) for i in range(deg)]
+		b = [1] + [random.randint(0, 1) for i in range(deg)]
+		times = []
+		for name in ("schoolbook", "mult", "div"):
+			if name == "schoolbook" and deg > 4096: #minutes, and the trend is already clear
+				times.append(float("nan"))
+				continue
+			start = time.perf_counter()
+			if name == "schoolbook":
+				schoolbook(a, b)
+			elif name == "mult":
+				prod = mult(a, b)
+			else:
+				div(prod, b)
+			times.append(time.perf_counter() - start)
+		print("{:8d} {:10.4f} {:10.4f} {:10.4f}".format(deg, *times))
 
 def mult(a, b):
-	"""Multiply two polynomials"""
+	"""Multiply two polynomials, with Karatsuba's three half size products once both have KARATSUBA coefficients"""
+	if len(a) < len(b):
+		a, b = b, a
+	if len(b) < KARATSUBA:
+		return schoolbook(a, b)
+	ret = [0] * (len(a)+len(b)-1)
+	for start in range(0, len(a), len(b)): #a longer a is taken in pieces the size of b, the last one zero padded
+		piece = a[start:start+len(b)]
+		piece += [0] * (len(b) - len(piece))
+		for idx, coeff in enumerate(karatsuba(piece, b)[:len(ret) - start], start):
+			ret[idx] += coeff
+	return ret
+
+def karatsuba(a, b):
+	"""Product of two polynomials with the same number of coefficients
+	Coefficients only need to line up by index, so the most significant first lists are split as they are"""
+	if len(a) < KARATSUBA:
+		return schoolbook(a, b)
+	half = len(a) // 2
+	a0, a1 = a[:half], a[half:]
+	b0, b1 = b[:half], b[half:]
+	asum, bsum = a1[:], b1[:]
+	for idx in range(half):
+		asum[idx] += a0[idx]
+		bsum[idx] += b0[idx]
+	low = karatsuba(a0, b0)
+	high = karatsuba(a1, b1)
+	mid = karatsuba(asum, bsum)
+	for idx, coeff in enumerate(low):
+		mid[idx] -= coeff
+	for idx, coeff in enumerate(high):
+		mid[idx] -= coeff
+	ret = low + [0] + high
+	for idx, coeff in enumerate(mid, half):
+		ret[idx] += coeff
+	return ret
+
+def schoolbook(a, b):
+	"""Multiply two polynomials one coefficient pair at a time"""
 	ret = [0] * (len(a)+len(b)-1)
 	for orderA, coeffA in enumerate(a):
-		for orderB, coeffB in enumerate(b):
-			#print("ret[{}] = {} + {} % 2 = {}".format(orderA+orderB, coeffA*coeffB, ret[orderA+orderB], (coeffA*coeffB + ret[orderA+orderB]) % 2))
-			ret[orderA+orderB] = (coeffA*coeffB + ret[orderA+orderB])
-	#print(ret)
+		if coeffA:
+			for orderB, coeffB in enumerate(b, orderA):
+				ret[orderB] += coeffA*coeffB
 	return ret
 
 def degree(poly):
@@ -98,19 +461,24 @@ def revDeg(poly):
 	return len(poly)-1
 
 def div(N, D):
-	"""Divide the two given polynomials"""
+	"""Divide the two given polynomials
+	The remainder is worked on in place, each step only touching the coefficients under the divisor's terms"""
 	N = N[::-1]
 	D = D[::-1]
 	dD = revDeg(D)
 	dN = revDeg(N)
 	if dD < 0: raise ZeroDivisionError
 	if dN >= dD:
-		q = [0] * dN
+		q = [0] * max(dN, dN - dD + 1)
+		terms = [(idx, coeff) for idx, coeff in enumerate(D) if coeff]
+		for idx in range(dN + 1): #where the divisor has no term a step only takes the absolute value, so do that once
+			if idx < dN - dD or not D[idx - dN + dD]:
+				N[idx] = abs(N[idx] - 0.0)
 		while dN >= dD:
-			d = [0]*(dN - dD) + D
-			mult = q[dN - dD] = N[-1] / float(d[-1])
-			d = [coeff*mult for coeff in d]
-			N = [abs(coeffN - coeffd) for coeffN, coeffd in zip(N, d)]
+			shift = dN - dD
+			mult = q[shift] = N[-1] / float(D[-1])
+			for idx, coeff in terms:
+				N[idx + shift] = abs(N[idx + shift] - coeff*mult)
 			dN = revDeg(N)
 		r = N
 	else:
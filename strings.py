@@ -1,22 +1,56 @@
 #!/usr/bin/env python3
 
-import sys, traceback
+import sys, traceback, getopt, os, re, time, itertools, io, mmap, stat
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 size = 4
+radix = None #offset format given with -t, None for no offsets
+encodings = "s" #character encodings given with -e, s = 7-bit, l = 16-bit little endian, b = 16-bit big endian
 cur = []
+BLOCK = 1 << 20 #bytes read at a time
+CHUNK = 16 * BLOCK #bytes scanned per task with --jobs
+PRINTABLE = bytes(1 if 0x20 <= b <= 0x7E or b == 0x09 else 0 for b in range(256)) #byte -> 1 if printable, else 0
+UNITS = {"s": rb"[\x20-\x7E\t]", "l": rb"[\x20-\x7E\t]\x00", "b": rb"\x00[\x20-\x7E\t]"} #one character in each encoding
+CONTINUE = {enc: re.compile(rb"(?:%s)*" % unit) for enc, unit in UNITS.items()}
+UNFINISHED = {"s": re.compile(b""), "l": re.compile(rb"[\x20-\x7E\t]?"), "b": re.compile(rb"\x00?")} #what may follow the end of a run that can still go on
+OFFSETS = {"d": b"%7d ", "o": b"%7o ", "x": b"%7x "}
+BREAKS = {True: re.compile(rb"[^\x20-\x7E\t]"), False: re.compile(rb"[^\x20-\x7E\t\x00]|\x00(?=\x00)")} #bytes no run can cross, by 7-bit only
 
 def main(args):
 	"""Checks for proper argument structure, then calls the translate function"""
-	global size
-	if not args and len(args) != 3:
+	global size, radix, encodings
+	try:
+		opts, args = getopt.getopt(args[1:], "t:e:j:", ["bench", "jobs="])
+		jobs = 1
+		for opt, val in opts:
+			if opt == "-t":
+				radix = val
+			elif opt == "-e":
+				encodings = "".join(enc for enc in "slb" if enc in val)
+			elif opt in ("-j", "--jobs"):
+				jobs = int(val)
+	except (getopt.GetoptError, ValueError):
+		usage()
+		sys.exit(2)
+	if len(args) != 2 or radix not in (None, "d", "o", "x") or not encodings or jobs < 1:
 		usage()
 		sys.exit(2)
 	try:
-		size = int(args[1])
-		with open(args[2], "rb") as fd:
+		size = int(args[0])
+		if size < 1:
+			usage()
+			sys.exit(2)
+		if ("--bench", "") in opts:
+			bench(args[1])
+			return
+		if jobs > 1:
+			parallel(args[1], jobs)
+			return
+		with open(args[1], "rb") as fd:
 			translate(fd)
 	except IOError as e:
-		print("IO Error: " + sys.exc_info()[1])
+		print("IO Error: " + str(sys.exc_info()[1]))
 		sys.exit(1) #indicate an error occured
 	except Exception as e:
 		print("Exception raised: " + str(sys.exc_info()[1]))
@@ -24,16 +58,127 @@ def main(args):
 		usage()
 		sys.exit(1) #indicate an error occurred
 
-def translate(fd):
-	"""reads the file 1 line at a time"""
-	line = fd.readline()
-	while line:
-		process(line)
-		line = fd.readline()
+def translate(fd, out=None):
+	"""reads the file BLOCK bytes at a time, so memory stays flat whatever the file looks like"""
+	if out is None:
+		out = sys.stdout.buffer
+	scan(iter(lambda: fd.read(BLOCK), b""), out)
+	out.flush()
+
+def parallel(path, jobs, out=None):
+	"""Scans the file in CHUNK sized pieces across a process pool, writing the results in file order
+	Each piece is moved to the first byte after its start that no run can cross, so every string belongs to exactly one
+	piece and the output is the same as translate's. At most two pieces per worker are in flight"""
+	if out is None:
+		out = sys.stdout.buffer
+	if not stat.S_ISREG(os.stat(path).st_mode): #pipes and devices have no size to plan pieces from, or to map
+		with open(path, "rb") as fd:
+			translate(fd, out)
+		return
+	total = os.path.getsize(path)
+	with ProcessPoolExecutor(jobs) as pool:
+		pending = deque()
+		for start in range(0, total, CHUNK):
+			pending.append(pool.submit(scanChunk, path, start, size, radix, encodings))
+			while len(pending) > 2 * jobs or (pending and start + CHUNK >= total):
+				out.write(pending.popleft().result())
+	out.flush()
+
+def scanChunk(path, start, length, offsets, encs):
+	"""Worker side of parallel, returns the output for the strings starting in the piece at start
+	The piece runs on past its nominal end up to the next cut, which is where the following piece starts"""
+	global size, radix, encodings
+	size, radix, encodings = length, offsets, encs
+	buf = io.BytesIO()
+	with open(path, "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+		lo, hi = cut(mm, start), cut(mm, start + CHUNK)
+		scan((mm[pos:min(pos + BLOCK, hi)] for pos in range(lo, hi, BLOCK)), buf, lo)
+	return buf.getvalue()
+
+def cut(data, pos):
+	"""Returns the first position at or after pos that no run can cross"""
+	if pos <= 0 or pos >= len(data):
+		return min(max(pos, 0), len(data))
+	match = BREAKS[encodings == "s"].search(data, pos - 1)
+	return match.end() if match else len(data)
 
+def scan(blocks, out, offset=0):
+	"""Writes out every run of at least size characters, in any of the encodings, found in the stream of blocks
+	offset is the file offset of the first block. Every encoding is searched in the same pass over each block,
+	and where runs of two encodings overlap the one starting first wins.
+	A run that reaches the end of a block is written as soon as it is long enough and finished in the next block,
+	a shorter one is carried over, so neither has to be held in memory whole"""
+	find = finder()
+	prefix = OFFSETS.get(radix)
+	carry = b"" #end of the last block, which may still start or continue a run
+	partial = None #encoding of a run that has been written out but not ended
+	for block in itertools.chain(blocks, [b""]):
+		#the empty block at EOF flushes out the carry
+		data = carry + block
+		pos = 0
+		found = []
+		if partial:
+			pos = CONTINUE[partial].match(data).end()
+			found.append(text(data[:pos], partial))
+			if block and UNFINISHED[partial].fullmatch(data, pos):
+				out.write(found[0])
+				offset += pos
+				carry = data[pos:]
+				continue
+			found.append(b"\n")
+			partial = None
+		end = pos
+		for start, end, enc in find(data, pos):
+			if prefix:
+				found.append(prefix % (offset + start))
+			found.append(text(data[start:end], enc))
+			if block and UNFINISHED[enc].fullmatch(data, end):
+				#the run may go on into the next block, leave it open
+				partial = enc
+				break
+			found.append(b"\n")
+		if partial:
+			carry = data[end:]
+		else:
+			#only a run shorter than size can be cut off at the end of the block
+			carry = data[max(end, len(data) - 2 * size):]
+		offset += len(data) - len(carry)
+		out.write(b"".join(found))
 
-def process(line):
-	"""Reads through the line 2 bytes at a time, printing all strings found"""
+def finder():
+	"""Returns find(data, pos), which yields (start, end, encoding) of each run of at least size characters in data"""
+	if encodings == "s":
+		def find(data, pos):
+			#the common case, a mask and bytes.find
+			for start, end in runs(data.translate(PRINTABLE), size, pos):
+				yield start, end, "s"
+		return find
+	pattern = re.compile(b"|".join(b"((?:%s){%d,})" % (UNITS[enc], max(size, 1)) for enc in encodings))
+	def find(data, pos):
+		for match in pattern.finditer(data, pos):
+			yield match.start(), match.end(), encodings[match.lastindex - 1]
+	return find
+
+def text(data, enc):
+	"""Returns the characters of a run of the given encoding as 7-bit bytes"""
+	return data if enc == "s" else data.replace(b"\x00", b"")
+
+def runs(mask, length, pos=0):
+	"""Yields (start, end) for every run of at least length printable bytes in a mask made with PRINTABLE
+	Runs are located with bytes.find on the mask, so only the strings themselves cost any python"""
+	needle = b"\x01" * max(length, 1)
+	while True:
+		start = mask.find(needle, pos)
+		if start < 0:
+			return
+		end = mask.find(b"\x00", start + len(needle))
+		if end < 0:
+			end = len(mask)
+		yield start, end
+		pos = end
+
+def bytewise(line):
+	"""The original scan, a byte at a time through the line. Kept for --bench"""
 	global cur
 	string = ""
 	last = "00"
@@ -50,9 +195,35 @@ def process(line):
 	if len(cur) >= size: #final print for EOF
 		print(''.join(cur))
 
+def bench(path):
+	"""Times the byte at a time scan against the block scan, and the block scan across 1, 2, 4 and 8 workers
+	Output goes to devnull"""
+	global cur
+	total = os.path.getsize(path)
+	results = []
+	stdout = sys.stdout
+	for name in ("bytewise", "translate", "jobs=1", "jobs=2", "jobs=4", "jobs=8"):
+		cur = []
+		with open(path, "rb") as fd, open(os.devnull, "w") as null:
+			start = time.perf_counter()
+			if name == "bytewise":
+				sys.stdout = null
+				try:
+					for line in fd:
+						bytewise(line)
+				finally:
+					sys.stdout = stdout
+			elif name == "translate":
+				translate(fd, null.buffer)
+			else:
+				parallel(path, int(name[5:]), null.buffer)
+			elapsed = time.perf_counter() - start
+		results.append(elapsed)
+		print("{:>10s}: {:8.3f}s {:10.2f} MB/s {:8.1f}x".format(name, elapsed, total / elapsed / 1e6 if elapsed else 0, results[0] / elapsed if elapsed else 0))
+
 def usage():
 	"""Prints the usage of this script"""
-	print("strings <size> <inputfile>")
+	print("strings [-t d|o|x] [-e s|l|b...] [-j|--jobs <n>] [--bench] <size> <inputfile>")
 
 if __name__ == "__main__":
 	main(sys.argv)